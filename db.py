@@ -0,0 +1,94 @@
+from typing import Any
+import msgspec
+
+# SQL kept as constants so SQLite's statement cache reuses the compiled form
+INSERT_QUIZ_SQL = "INSERT INTO quizzes (name, creator_id, num_questions, questions) VALUES (?, ?, ?, ?)"
+SELECT_ALL_QUIZZES_SQL = "SELECT id, name, creator_id, num_questions FROM quizzes"
+SELECT_QUIZ_SQL = "SELECT name, creator_id, questions FROM quizzes WHERE id = ?"
+UPSERT_SCORE_SQL = (
+    "INSERT INTO leaderboard (user_id, name, score, total) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "name = excluded.name, score = excluded.score, total = excluded.total"
+)
+SELECT_TOP_SCORES_SQL = "SELECT user_id, name, score, total FROM leaderboard ORDER BY score DESC LIMIT ?"
+
+# Database setup
+async def migrate_legacy_quizzes(db):
+    """Bring a quizzes table from the original schema up to date in place.
+
+    That table stored questions as JSON text and had no num_questions
+    column. Its rows are re-encoded as msgpack in one transaction; a row
+    that does not decode aborts startup before anything is written.
+    """
+    async with db.execute("PRAGMA table_info(quizzes)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if not columns or "num_questions" in columns:
+        return
+    async with db.execute("SELECT id, questions FROM quizzes") as cursor:
+        rows = await cursor.fetchall()
+    updates = []
+    for quiz_id, questions in rows:
+        questions = msgspec.json.decode(questions)
+        updates.append((len(questions), msgspec.msgpack.encode(questions), quiz_id))
+    await db.execute("BEGIN")
+    await db.execute("ALTER TABLE quizzes ADD COLUMN num_questions INTEGER NOT NULL DEFAULT 0")
+    await db.executemany("UPDATE quizzes SET num_questions = ?, questions = ? WHERE id = ?", updates)
+    await db.commit()
+
+async def init_db(db):
+    await migrate_legacy_quizzes(db)
+    await db.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-20000;
+        CREATE TABLE IF NOT EXISTS quizzes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            creator_id INTEGER NOT NULL,
+            num_questions INTEGER NOT NULL,
+            questions BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            total INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leaderboard_score ON leaderboard (score DESC);
+    ''')
+    await db.commit()
+
+async def save_quiz(db, name, creator_id, questions):
+    async with db.execute(
+        INSERT_QUIZ_SQL,
+        (name, creator_id, len(questions), msgspec.msgpack.encode(questions))
+    ) as cursor:
+        quiz_id = cursor.lastrowid
+    await db.commit()
+    return quiz_id
+
+async def get_all_quizzes(db):
+    """Return (id, name, creator_id, num_questions) for every quiz, without questions."""
+    async with db.execute(SELECT_ALL_QUIZZES_SQL) as cursor:
+        return await cursor.fetchall()
+
+async def get_quiz_by_id(db, quiz_id, questions_type=Any):
+    """Return (name, creator_id, questions) for a quiz, or None if it does not exist.
+
+    The questions are decoded straight into `questions_type`.
+    """
+    async with db.execute(SELECT_QUIZ_SQL, (quiz_id,)) as cursor:
+        quiz = await cursor.fetchone()
+    if not quiz:
+        return None
+    name, creator_id, questions = quiz
+    return name, creator_id, msgspec.msgpack.decode(questions, type=questions_type)
+
+async def save_score(db, user_id, name, score, total):
+    await db.execute(UPSERT_SCORE_SQL, (user_id, name, score, total))
+    await db.commit()
+
+async def get_top_scores(db, limit):
+    """Return the best (user_id, name, score, total) leaderboard rows."""
+    async with db.execute(SELECT_TOP_SCORES_SQL, (limit,)) as cursor:
+        return await cursor.fetchall()
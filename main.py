@@ -1,19 +1,17 @@
 import os
-import json
 import logging
-import sqlite3
-import random
+import orjson
+import aiosqlite
+import anyio.to_thread
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from fastapi.responses import Response
 import uvicorn
 from telegram import Update
-from telegram.ext import Application
+from telegram.ext import AIORateLimiter, Application
 from dotenv import load_dotenv
-from utils import (
-    start, upload_document, my_quizzes, all_quizzes,
-    start_quiz_conversation, quiz_answer_handler, cancel_quiz,
-    quit_quiz, setup_handlers, QUIZ_TAKING
-)
+from db import init_db
+from utils import setup_handlers, load_quizzes, ChatUpdateProcessor
 
 # Load environment variables
 load_dotenv()
@@ -30,73 +28,61 @@ API_TOKEN = os.getenv('BOT_API_KEY')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 8000))
 DB_FILE = "quizzes.db"
+THREAD_LIMIT = 200
+MAX_CONCURRENT_UPDATES = 256
 
-# Initialize bot application
-application = Application.builder().token(API_TOKEN).build()
-
-# Database setup
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS quizzes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            creator_id INTEGER NOT NULL,
-            questions TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
+# Pre-serialized responses for the hot endpoints
+OK_RESP = Response(b'{"ok":true}', media_type="application/json")
+HEALTH_RESP = Response(b'{"status":"ok"}', media_type="application/json")
 
-def save_quiz(name, creator_id, questions):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO quizzes (name, creator_id, questions) VALUES (?, ?, ?)",
-        (name, creator_id, json.dumps(questions))
-    )
-    conn.commit()
-    conn.close()
-
-def get_all_quizzes():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM quizzes")
-    quizzes = cursor.fetchall()
-    conn.close()
-    return quizzes
+# Initialize bot application
+# The rate limiter queues sends to stay within Telegram's flood limits
+# (about 30 messages per second overall) instead of hitting RetryAfter errors.
+# HTTP/2 multiplexes concurrent Bot API calls over one TLS connection, and
+# updates from different chats are handled concurrently.
+application = (
+    Application.builder()
+    .token(API_TOKEN)
+    .rate_limiter(AIORateLimiter())
+    .http_version("2")
+    .concurrent_updates(ChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    .build()
+)
 
-def get_quiz_by_id(quiz_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT questions FROM quizzes WHERE id = ?", (quiz_id,))
-    quiz = cursor.fetchone()
-    conn.close()
-    if quiz:
-        questions = json.loads(quiz[0])
-        random.shuffle(questions)
-        return questions
-    return None
+# Bound once for the webhook hot path; the update queue is unbounded, so
+# put_nowait never raises QueueFull and saves an await per update.
+_de_json = Update.de_json
+_bot = application.bot
+_queue_put = application.update_queue.put_nowait
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Give run_in_threadpool more headroom than anyio's default of 40 so a
+    # burst of blocking work cannot starve the webhook route.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_LIMIT
+    app.state.db = await aiosqlite.connect(DB_FILE)
     try:
-        init_db()
+        await init_db(app.state.db)
+        await load_quizzes(app.state.db)
+        application.bot_data["db"] = app.state.db
         await setup_handlers(application)
-        webhook_info = await application.bot.get_webhook_info()
-        if webhook_info.url != WEBHOOK_URL:
-            await application.bot.set_webhook(url=f"{WEBHOOK_URL}/{API_TOKEN}")
-        await application.initialize()
-        await application.start()
-        logger.info("Bot started with webhook")
-        yield
+        # The bot shares uvicorn's event loop: updates arrive through the
+        # webhook route, so there is no polling thread or second loop.
+        async with application:
+            webhook_info = await application.bot.get_webhook_info()
+            if webhook_info.url != WEBHOOK_URL:
+                await application.bot.set_webhook(url=f"{WEBHOOK_URL}/{API_TOKEN}")
+            await application.start()
+            logger.info("Bot started with webhook")
+            try:
+                yield
+            finally:
+                await application.stop()
     except Exception as e:
         logger.error(f"Error during startup: {e}")
         raise
     finally:
-        await application.stop()
-        await application.shutdown()
+        await app.state.db.close()
         logger.info("Bot stopped")
 
 # Create FastAPI app with lifespan handler
@@ -105,22 +91,23 @@ app = FastAPI(lifespan=lifespan)
 @app.post(f"/{API_TOKEN}")
 async def webhook_handler(request: Request):
     try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.update_queue.put(update)
-        return {"ok": True}
+        _queue_put(_de_json(orjson.loads(await request.body()), _bot))
+        return OK_RESP
     except Exception as e:
         logger.error(f"Error in webhook handler: {e}")
         return {"ok": False, "error": str(e)}
 
 @app.get("/")
 async def health_check():
-    return {"status": "ok"}
+    return HEALTH_RESP
 
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=PORT,
-        reload=False
+        reload=False,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
     )
@@ -1,8 +1,16 @@
-import json
+import io
 import logging
+import re
+import sys
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import msgspec
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -11,17 +19,97 @@ from telegram.ext import (
     filters,
 )
 import asyncio
+from db import save_quiz, get_all_quizzes, get_quiz_by_id, save_score, get_top_scores
 
 logger = logging.getLogger(__name__)
 
-# Global storage
-quizzes = {}
-leaderboard = {}
-next_quiz_id = 1
+class Question(msgspec.Struct):
+    """A single quiz question, decoded and type-checked once at upload time."""
+    question: str
+    options: tuple[str, ...]
+    correct_option: int
+
+@dataclass(slots=True)
+class Quiz:
+    """An uploaded quiz together with its prebuilt keyboards."""
+    name: str
+    creator_id: int
+    questions: list[Question]
+    q_markups: list[InlineKeyboardMarkup]
+
+# Global storage; quizzes and scores persist in SQLite (see db.py)
+# Recently used quizzes with their prebuilt keyboards, oldest first
+quizzes = OrderedDict()
+
+# Listing button of every quiz, loaded at startup without the questions
+list_buttons = {}
+
+# Top 5 leaderboard rows, rebuilt lazily after a score changes
+top5_cache = None
+# Bumped on every invalidation, so a rebuild that raced one is not cached
+top5_generation = 0
+
+# Quiz ids per creator, so /myquizzes never scans every quiz
+creator_index = defaultdict(list)
+
+# Dedicated pool so parsing large uploads neither blocks the event loop nor
+# competes with the default executor
+json_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="json")
 
 # Constants
 QUIZ_TAKING = 1
 QUESTION_TIMEOUT = 20
+QUIZ_CACHE_SIZE = 256
+
+# Callback data pattern of the quiz entry point, compiled once
+TAKE_QUIZ_PATTERN = re.compile(r"^takequiz_\d+$")
+
+# "answer_{q_idx}_{idx}" callback strings per question index, shared by
+# every quiz's keyboards
+ANSWER_CALLBACKS = []
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Process updates from different chats concurrently, but in order within a chat.
+
+    A slow handler in one chat (a large upload, a slow Bot API call) no
+    longer holds up every other chat, while each chat's conversation still
+    sees its updates one at a time.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # The base class takes its semaphore before do_process_update, so it
+        # is left unbounded; the real limit is only taken once the chat's
+        # turn has come, so a backlog in one chat cannot hold slots other
+        # chats need.
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat id -> [lock, number of updates holding or awaiting it]
+        self._chats = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 async def setup_handlers(application: Application):
     """Set up all handlers for the bot."""
@@ -33,10 +121,11 @@ async def setup_handlers(application: Application):
         application.add_handler(MessageHandler(filters.Document.ALL, upload_document))
 
         conv_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(start_quiz_conversation, pattern=r"^takequiz_\d+$")],
+            entry_points=[CallbackQueryHandler(start_quiz_conversation, pattern=TAKE_QUIZ_PATTERN)],
             states={
                 QUIZ_TAKING: [
-                    CallbackQueryHandler(quiz_answer_handler, pattern=r"^(answer_\d+|restart_quiz)$"),
+                    # quiz_answer_handler dispatches on the callback prefix itself
+                    CallbackQueryHandler(quiz_answer_handler),
                     CommandHandler("quit", quit_quiz),
                 ]
             },
@@ -48,6 +137,106 @@ async def setup_handlers(application: Application):
         logger.error(f"Error setting up handlers: {e}")
         raise
 
+def answer_callbacks(q_idx: int, count: int) -> list:
+    """Return the shared "answer_{q_idx}_{idx}" callback strings for `count` options.
+
+    Carrying the question index lets a tap that arrives after its question
+    timed out be told apart from an answer to the next one.
+    """
+    while len(ANSWER_CALLBACKS) <= q_idx:
+        ANSWER_CALLBACKS.append([])
+    callbacks = ANSWER_CALLBACKS[q_idx]
+    while len(callbacks) < count:
+        callbacks.append(f"answer_{q_idx}_{len(callbacks)}")
+    return callbacks
+
+def intern_options(questions: list[Question]) -> list[Question]:
+    """Intern option labels, so labels repeated across questions and quizzes
+    ("True", "False", ...) share one string object."""
+    for q in questions:
+        q.options = tuple(map(sys.intern, q.options))
+    return questions
+
+def decode_questions(raw) -> list[Question]:
+    """Decode and schema-check an uploaded quiz file in one pass."""
+    return intern_options(msgspec.json.decode(raw, type=list[Question]))
+
+def find_invalid_question(questions: list[Question]) -> int:
+    """Return the index of the first question whose correct_option is out of range, or -1."""
+    for i, q in enumerate(questions):
+        if not 0 <= q.correct_option < len(q.options):
+            return i
+    return -1
+
+def make_list_button(quiz_id: int, name: str, num_questions: int) -> InlineKeyboardButton:
+    """Build the /allquizzes and /myquizzes button that starts a quiz."""
+    return InlineKeyboardButton(
+        f"{name} (ID: {quiz_id}, {num_questions} questions)",
+        callback_data=f"takequiz_{quiz_id}",
+    )
+
+def cache_quiz(quiz_id: int, name: str, creator_id: int, questions: list[Question]) -> Quiz:
+    """Build a Quiz with its keyboards and keep it among the hot quizzes."""
+    quiz = quizzes[quiz_id] = Quiz(
+        name=name,
+        creator_id=creator_id,
+        questions=questions,
+        q_markups=[
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton(option, callback_data=answer_cb)]
+                for option, answer_cb in zip(q.options, answer_callbacks(q_idx, len(q.options)))
+            ])
+            for q_idx, q in enumerate(questions)
+        ],
+    )
+    if len(quizzes) > QUIZ_CACHE_SIZE:
+        quizzes.popitem(last=False)
+    return quiz
+
+async def get_quiz(db, quiz_id: int) -> Quiz | None:
+    """Return a quiz from the hot cache, loading it from the database on a miss."""
+    quiz = quizzes.get(quiz_id)
+    if quiz is not None:
+        quizzes.move_to_end(quiz_id)
+        return quiz
+    row = await get_quiz_by_id(db, quiz_id, questions_type=list[Question])
+    if row is None:
+        return None
+    name, creator_id, questions = row
+    questions = intern_options(questions)
+    return cache_quiz(quiz_id, name, creator_id, questions)
+
+async def load_quizzes(db) -> None:
+    """Load the listing buttons and creator index of every stored quiz."""
+    for quiz_id, name, creator_id, num_questions in await get_all_quizzes(db):
+        list_buttons[quiz_id] = make_list_button(quiz_id, name, num_questions)
+        creator_index[creator_id].append(quiz_id)
+
+async def record_score(db, user_id: int, name: str, score: int, total: int) -> None:
+    """Store a finished quiz result and invalidate the cached top 5 if needed."""
+    global top5_cache, top5_generation
+    await save_score(db, user_id, name, score, total)
+    # A new score strictly below a full cached top 5 cannot change it
+    if top5_cache is None or (
+        len(top5_cache) < 5
+        or score >= top5_cache[-1][2]
+        or any(row[0] == user_id for row in top5_cache)
+    ):
+        top5_cache = None
+        top5_generation += 1
+
+async def leaderboard_top5(db) -> list:
+    """Return the five best leaderboard rows, querying only when invalidated."""
+    global top5_cache
+    if top5_cache is None:
+        generation = top5_generation
+        rows = await get_top_scores(db, 5)
+        # Only cache the rows if no score was recorded during the query
+        if generation == top5_generation:
+            top5_cache = rows
+        return rows
+    return top5_cache
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message and instructions."""
     try:
@@ -79,27 +268,37 @@ async def upload_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     document = update.message.document
     if document.file_name.endswith(".json"):
         file = await document.get_file()
-        file_bytes = await file.download_as_bytearray()
+        # Download straight into a buffer and parse its memoryview in place,
+        # so the file is held in memory only once.
+        buffer = io.BytesIO()
+        await file.download_to_memory(buffer)
         try:
-            data = json.loads(file_bytes.decode("utf-8"))
-            if not isinstance(data, list):
-                await update.message.reply_text("The JSON must be a list of questions.")
+            loop = asyncio.get_running_loop()
+            try:
+                questions = await loop.run_in_executor(json_executor, decode_questions, buffer.getbuffer())
+            except msgspec.ValidationError as e:
+                await update.message.reply_text(f"Invalid quiz: {e}")
                 return
 
             # Use the file name (without extension) as the quiz name.
-            quiz_name = document.file_name.rsplit(".", 1)[0]
-            global next_quiz_id
-            quiz_id = next_quiz_id
-            next_quiz_id += 1
-
-            # Save quiz details (you can add validation of question structure if desired)
-            quizzes[quiz_id] = {
-                "name": quiz_name,
-                "creator_id": update.effective_user.id,
-                "questions": data
-            }
-            # Send success message with inline button
-            keyboard = [[InlineKeyboardButton("Start Quiz", callback_data=f"takequiz_{quiz_id}")]]
+            quiz_name = document.file_name[:-5]
+            user_id = update.effective_user.id
+            invalid = find_invalid_question(questions)
+            if invalid != -1:
+                await update.message.reply_text(
+                    f"Question {invalid + 1} has a correct_option outside its options."
+                )
+                return
+
+            # Persist the quiz, then build its keyboards once for every
+            # listing and question display.
+            quiz_id = await save_quiz(context.bot_data["db"], quiz_name, user_id, questions)
+            cache_quiz(quiz_id, quiz_name, user_id, questions)
+            button = list_buttons[quiz_id] = make_list_button(quiz_id, quiz_name, len(questions))
+            creator_index[user_id].append(quiz_id)
+            # Send success message with inline button, sharing the listing
+            # button's "takequiz_{quiz_id}" string
+            keyboard = [[InlineKeyboardButton("Start Quiz", callback_data=button.callback_data)]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await update.message.reply_text(
@@ -114,38 +313,23 @@ async def upload_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def my_quizzes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List quizzes created by the current user with inline buttons."""
     user_id = update.effective_user.id
-    user_quizzes = [
-        (quiz_id, quiz)
-        for quiz_id, quiz in quizzes.items()
-        if quiz["creator_id"] == user_id
-    ]
+    user_quiz_ids = creator_index.get(user_id)
 
-    if not user_quizzes:
+    if not user_quiz_ids:
         await update.message.reply_text("You haven't created any quizzes yet.")
         return
 
-    buttons = []
-    for quiz_id, quiz in user_quizzes:
-        num_questions = len(quiz["questions"])
-        button = InlineKeyboardButton(
-            f"{quiz['name']} (ID: {quiz_id}, {num_questions} questions)",
-            callback_data=f"takequiz_{quiz_id}",
-        )
-        buttons.append([button])
+    buttons = [[list_buttons[quiz_id]] for quiz_id in user_quiz_ids]
 
     reply_markup = InlineKeyboardMarkup(buttons)
     await update.message.reply_text("Your quizzes:", reply_markup=reply_markup)
 
 async def all_quizzes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """List all available quizzes with an inline button to take each quiz."""
-    if not quizzes:
+    if not list_buttons:
         await update.message.reply_text("No quizzes available yet.")
     else:
-        buttons = []
-        for quiz_id, quiz in quizzes.items():
-            num_questions = len(quiz["questions"])
-            button = InlineKeyboardButton(f"{quiz['name']} (ID: {quiz_id}, {num_questions} questions)", callback_data=f"takequiz_{quiz_id}")
-            buttons.append([button])
+        buttons = [[button] for button in list_buttons.values()]
         reply_markup = InlineKeyboardMarkup(buttons)
         await update.message.reply_text("Available quizzes:", reply_markup=reply_markup)
         
@@ -161,65 +345,108 @@ async def start_quiz_conversation(update: Update, context: ContextTypes.DEFAULT_
     """
     query = update.callback_query
     await query.answer()
-    data = query.data  # Expected format: "takequiz_{quiz_id}"
-    try:
-        quiz_id = int(data.split("_")[1])
-    except (IndexError, ValueError):
-        await query.message.reply_text("Invalid quiz ID.")
-        return ConversationHandler.END
+    quiz_id = int(query.data[9:])  # Strip the "takequiz_" prefix
 
-    if quiz_id not in quizzes:
+    quiz = await get_quiz(context.bot_data["db"], quiz_id)
+    if quiz is None:
         await query.message.reply_text("Quiz not found.")
         return ConversationHandler.END
 
     # Store the selected quiz and initialize quiz state in user_data.
-    context.user_data["current_quiz"] = quizzes[quiz_id]
+    cancel_question_timeout(context.user_data)
+    context.user_data["current_quiz"] = quiz
     context.user_data["quiz_id"] = quiz_id
     context.user_data["current_q"] = 0
     context.user_data["score"] = 0
 
-    await send_next_quiz_question(query, context)
+    await send_next_quiz_question(query.message, query.from_user, context)
     return QUIZ_TAKING
 
-async def send_next_quiz_question(query, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send the next question or finish the quiz."""
-    quiz = context.user_data.get("current_quiz")
-    current_q = context.user_data.get("current_q", 0)
-
-    if current_q < len(quiz["questions"]):
-        q = quiz["questions"][current_q]
-        keyboard = [
-            [InlineKeyboardButton(option, callback_data=f"answer_{idx}")]
-            for idx, option in enumerate(q["options"])
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(q["question"], reply_markup=reply_markup)
+async def send_next_quiz_question(
+    message, user, context: ContextTypes.DEFAULT_TYPE, feedback: str = None, edit: bool = False
+) -> None:
+    """Send the next question in reply to `message`, or finish the quiz.
 
-        # Remove the timer for now as it's causing issues with webhooks
-        # We can implement a different timeout mechanism if needed
-        
+    Answer feedback, when given, goes out in the same message as the next
+    question or the results, so each answer costs a single Telegram send.
+    With `edit`, `message` (the answered question) is edited in place
+    instead of replied to. Every question sent schedules a one-shot job
+    that skips it after QUESTION_TIMEOUT.
+    """
+    user_data = context.user_data
+    quiz = user_data["current_quiz"]
+    questions = quiz.questions
+    current_q = user_data["current_q"]
+    reply = message.edit_text if edit else message.reply_text
+
+    if current_q < len(questions):
+        q = questions[current_q]
+        reply_markup = quiz.q_markups[current_q]
+        if feedback is None:
+            sent = await reply(q.question, reply_markup=reply_markup)
+        else:
+            text = f"{feedback}\n\n{escape_markdown(q.question)}"
+            sent = await reply(text, reply_markup=reply_markup, parse_mode="Markdown")
+
+        user_data["timeout_job"] = context.job_queue.run_once(
+            question_timeout,
+            QUESTION_TIMEOUT,
+            data=(sent, user, current_q),
+            chat_id=sent.chat_id,
+            user_id=user.id,
+        )
     else:
         # Quiz finished: Update leaderboard
-        user_id = query.from_user.id
-        user_name = query.from_user.first_name
-        score = context.user_data.get("score", 0)
-        total = len(quiz["questions"])
+        user_id = user.id
+        user_name = user.first_name
+        score = user_data["score"]
+        total = len(questions)
 
-        leaderboard[user_id] = {"name": user_name, "score": score, "total": total}
+        db = context.bot_data["db"]
+        await record_score(db, user_id, user_name, score, total)
 
         # Generate leaderboard ranking
-        sorted_leaderboard = sorted(
-            leaderboard.items(), key=lambda x: x[1]["score"], reverse=True
+        lines = ["🏅 *Leaderboard:*"]
+        lines.extend(
+            f"{idx}. {escape_markdown(name)} - {best}/{out_of} 🎯"
+            for idx, (_, name, best, out_of) in enumerate(await leaderboard_top5(db), start=1)
         )
-        ranking_text = "🏅 *Leaderboard:*\n"
-        for idx, (uid, data) in enumerate(sorted_leaderboard[:5], start=1):  # Show top 5
-            ranking_text += f"{idx}. {data['name']} - {data['score']}/{data['total']} 🎯\n"
+        ranking_text = "\n".join(lines)
 
         text = f"🎉 *Quiz Completed!*\nYour score: {score}/{total}\n\n{ranking_text}"
+        if feedback is not None:
+            text = f"{feedback}\n\n{text}"
         keyboard = [[InlineKeyboardButton("Restart Quiz", callback_data="restart_quiz")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await query.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        await reply(text, reply_markup=reply_markup, parse_mode="Markdown")
+
+async def question_timeout(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reveal the answer to an unanswered question and move on to the next one."""
+    message, user, q_idx = context.job.data
+    user_data = context.user_data
+    # Ignore the job if the question was answered or the quiz quit meanwhile
+    if user_data.get("current_q") != q_idx:
+        return
+    user_data.pop("timeout_job", None)
+
+    q = user_data["current_quiz"].questions[q_idx]
+    feedback = f"⏰ Time's up! The correct answer was:\n\n✅ {escape_markdown(q.options[q.correct_option])}"
+    user_data["current_q"] += 1
+    try:
+        await send_next_quiz_question(message, user, context, feedback, edit=True)
+    except Exception as e:
+        logger.error(f"Error in question_timeout: {e}")
+        # Don't leave the quiz half-advanced with no question on screen
+        user_data.pop("current_quiz", None)
+        user_data.pop("current_q", None)
+        await message.reply_text("Sorry, the quiz could not continue. Type /quit and start it again.")
+
+def cancel_question_timeout(user_data: dict) -> None:
+    """Drop the pending timeout job of the current question, if any."""
+    job = user_data.pop("timeout_job", None)
+    if job is not None:
+        job.schedule_removal()
 
 
 async def quiz_answer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -228,33 +455,43 @@ async def quiz_answer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         await query.answer()  # Important: Acknowledge the button press first
         data = query.data
-
-        if data.startswith("answer_"):
-            selected = int(data.split("_")[1])
-            quiz = context.user_data.get("current_quiz")
-            current_q = context.user_data.get("current_q", 0)
-            q = quiz["questions"][current_q]
-
-            # Check if the answer is correct
-            if selected == q["correct_option"]:
-                context.user_data["score"] = context.user_data.get("score", 0) + 1
-                feedback = f"✅ Correct! 🎉\n\n🎯 *{q['question']}*\n✅ {q['options'][selected]}"
+        user_data = context.user_data
+
+        # Any callback reaches this state; other buttons leave the quiz alone
+        if data[:7] == "answer_":
+            # Strip the "answer_" prefix, leaving "{q_idx}_{idx}"
+            q_idx, _, selected = data[7:].partition("_")
+            current_q = user_data["current_q"]
+            # The question timed out (or was answered) before this tap arrived
+            if int(q_idx) != current_q:
+                return QUIZ_TAKING
+            cancel_question_timeout(user_data)
+            selected = int(selected)
+            q = user_data["current_quiz"].questions[current_q]
+            options = q.options
+            correct_option = q.correct_option
+
+            # Check if the answer is correct; the feedback is sent as
+            # Markdown, so the quiz's own text is escaped (and kept out of
+            # bold, since legacy Markdown cannot escape inside an entity)
+            answer = escape_markdown(options[correct_option])
+            if selected == correct_option:
+                user_data["score"] += 1
+                feedback = f"✅ Correct! 🎉\n\n🎯 {escape_markdown(q.question)}\n✅ {answer}"
             else:
-                correct_ans = q["options"][q["correct_option"]]
-                feedback = f"❌ Wrong! The correct answer was:\n\n✅ {correct_ans}"
-
-            # Send feedback message
-            await query.message.reply_text(feedback, parse_mode="Markdown")
+                feedback = f"❌ Wrong! The correct answer was:\n\n✅ {answer}"
 
-            # Move to next question
-            context.user_data["current_q"] += 1
-            await send_next_quiz_question(query, context)
+            # Move to next question, sending the feedback along with it
+            user_data["current_q"] += 1
+            # Replace the answered question with the feedback and what follows
+            await send_next_quiz_question(query.message, query.from_user, context, feedback, edit=True)
 
         elif data == "restart_quiz":
+            cancel_question_timeout(user_data)
             # Reset quiz state for restart
-            context.user_data["current_q"] = 0
-            context.user_data["score"] = 0
-            await send_next_quiz_question(query, context)
+            user_data["current_q"] = 0
+            user_data["score"] = 0
+            await send_next_quiz_question(query.message, query.from_user, context)
 
     except Exception as e:
         logger.error(f"Error in quiz_answer_handler: {e}")
@@ -266,12 +503,14 @@ async def quiz_answer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def cancel_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the current quiz conversation."""
+    cancel_question_timeout(context.user_data)
     if update.message:
         await update.message.reply_text("Quiz cancelled.")
     return ConversationHandler.END
 
 async def quit_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stops the quiz and resets the user's progress."""
+    cancel_question_timeout(context.user_data)
     context.user_data.clear()  # Reset user progress
 
     # If the user sent "/quit" as a message